@@ -1,186 +1,326 @@
-"""
-Emotion Detector Flask Application
-Handles user authentication, image upload, emotion detection, and dashboard analytics
-"""
-from flask import Flask, session, render_template, request, jsonify, redirect, url_for
-import os
-from werkzeug.utils import secure_filename
-import io
-import base64
-import cv2
-import numpy as np
-from helpers import recognize_emotion, generate_mood_content
-from PIL import Image
-import tempfile
-from datetime import datetime
-import uuid
-
-# Initialize Flask app
-app = Flask(__name__)
-app.secret_key = 'your-secret-key-emotion-detector'
-
-# Configuration
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
-MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50MB max file size
-
-def allowed_file(filename):
-    """Check if uploaded file has an allowed extension"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-@app.route('/')
-def home():
-    """Redirect to login if not authenticated, otherwise to main app"""
-    if 'username' in session:
-        return redirect(url_for('index'))
-    return redirect(url_for('login'))
-
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    """Handle user login with hardcoded credentials (user/54321)"""
-    if request.method == 'POST':
-        username = request.form.get('username', '')
-        password = request.form.get('password', '')
-        
-        # Validate credentials
-        if username == 'user' and password == '54321':
-            session['username'] = username
-            session['emotion_history'] = []  # Initialize emotion history for this session
-            return redirect(url_for('index'))
-        else:
-            return render_template('login.html', error='Invalid username or password')
-    
-    return render_template('login.html')
-
-@app.route('/logout')
-def logout():
-    """Clear session and redirect to login"""
-    session.clear()
-    return redirect(url_for('login'))
-
-@app.route('/index')
-def index():
-    """Main app page - image upload and emotion detection"""
-    if 'username' not in session:
-        return redirect(url_for('login'))
-    return render_template('index.html')
-
-@app.route('/dashboards')
-def dashboards():
-    """Analytics dashboard with charts and history"""
-    if 'username' not in session:
-        return redirect(url_for('login'))
-    return render_template('dashboards.html')
-
-@app.route('/api/process-emotion', methods=['POST'])
-def process_emotion():
-    """
-    Main API endpoint for emotion detection
-    1. Receives uploaded image
-    2. Detects face and emotion using DeepFace
-    3. Generates mood content (playlist recommendations)
-    4. Draws bounding box on image
-    5. Returns base64 image with emotion data
-    6. Stores result in session history
-    """
-    temp_path = None
-    try:
-        if 'username' not in session:
-            return jsonify({'message': 'Not authenticated'}), 401
-        
-        if 'image' not in request.files:
-            return jsonify({'message': 'No image provided'}), 400
-        
-        file = request.files['image']
-        if file.filename == '' or not allowed_file(file.filename):
-            return jsonify({'message': 'Invalid file'}), 400
-        
-        # Create a unique temp file with explicit control
-        import uuid
-        temp_filename = f"temp_{uuid.uuid4().hex}.jpg"
-        temp_path = os.path.join(tempfile.gettempdir(), temp_filename)
-        
-        # Save the uploaded file to temp location
-        file.save(temp_path)
-        
-        # Recognize emotion
-        emotion_result = recognize_emotion(temp_path)
-        
-        if emotion_result is None:
-            return jsonify({'message': 'No face detected in image'}), 400
-        
-        # Generate mood content (AI-generated playlist recommendation)
-        mood_text = generate_mood_content(emotion_result['label'], emotion_result['confidence'])
-        
-        # Read image and draw bounding box
-        img = cv2.imread(temp_path)
-        if img is None:
-            return jsonify({'message': 'Error reading image'}), 500
-        
-        # Draw bounding box around detected face with emotion label
-        box = emotion_result['box']
-        x, y, w, h = box['x'], box['y'], box['w'], box['h']
-        cv2.rectangle(img, (x, y), (x + w, y + h), (0, 255, 0), 2)
-        cv2.putText(img, f"{emotion_result['label']} ({emotion_result['confidence']:.1f}%)", 
-                   (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
-        
-        # Convert image to base64 for transmission to frontend
-        _, buffer = cv2.imencode('.jpg', img)
-        img_base64 = base64.b64encode(buffer).decode('utf-8')
-        
-        # Generate timestamp-based filename for history tracking
-        filename = f"{emotion_result['label']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        
-        # Convert confidence to regular float for JSON serialization
-        confidence = float(emotion_result['confidence'])
-        
-        # Store emotion data in session history for dashboard analytics
-        if 'emotion_history' not in session:
-            session['emotion_history'] = []
-        
-        history_entry = {
-            'emotion': emotion_result['label'],
-            'confidence': confidence,
-            'filename': filename
-        }
-        session['emotion_history'].append(history_entry)
-        session.modified = True
-        
-        # Return processed image and analysis data to frontend
-        return jsonify({
-            'image': f'data:image/jpeg;base64,{img_base64}',
-            'emotion': emotion_result['label'],
-            'confidence': confidence,
-            'mood_text': mood_text
-        })
-    except Exception as e:
-        return jsonify({'message': f'Error: {str(e)}'}), 500
-    finally:
-        # Clean up temporary file to prevent disk space waste
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except Exception as e:
-                print(f"Warning: Failed to delete temp file {temp_path}: {e}")
-
-@app.route('/api/get-history')
-def get_history():
-    """Retrieve emotion detection history for current session"""
-    if 'username' not in session:
-        return jsonify({'message': 'Not authenticated'}), 401
-    
-    history = session.get('emotion_history', [])
-    return jsonify({'history': history})
-
-@app.route('/api/clear-history', methods=['POST'])
-def clear_history():
-    """Clear all emotion history for current session"""
-    if 'username' not in session:
-        return jsonify({'message': 'Not authenticated'}), 401
-    
-    session['emotion_history'] = []
-    session.modified = True
-    return jsonify({'message': 'History cleared'})
-
-if __name__ == '__main__':
-    # Run Flask development server
-    app.run(debug=True)
+"""
+Emotion Detector Flask Application
+Handles user authentication, image upload, emotion detection, and dashboard analytics
+"""
+from flask import Flask, session, render_template, request, jsonify, redirect, url_for, send_file, Response, stream_with_context
+import os
+import io
+import json
+import cv2
+import imagesize
+import numpy as np
+from helpers import recognize_emotion, stream_mood_content, EMOTION_LABELS
+from flask_caching import Cache
+from datetime import datetime
+import uuid
+
+# Optional libjpeg-turbo bindings - SIMD JPEG encode is ~2-3x faster than
+# cv2.imencode. Falls back to OpenCV when PyTurboJPEG isn't installed.
+try:
+    from turbojpeg import TurboJPEG
+    _turbo_jpeg = TurboJPEG()
+except Exception:
+    _turbo_jpeg = None
+
+# Optional Rust JSON encoder - 3-5x faster than stdlib json and returns
+# bytes directly. Falls back to jsonify when orjson isn't installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_response(payload, status=200):
+    """Build a JSON response via orjson when available, jsonify otherwise"""
+    if orjson is not None:
+        return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+    return jsonify(payload), status
+
+# Initialize Flask app
+app = Flask(__name__)
+app.secret_key = 'your-secret-key-emotion-detector'
+
+# Server-side store for emotion history. Keeping history in the cookie
+# session re-signed and re-sent the whole list on every response and
+# overflows the 4KB cookie limit after ~100 detections. Uses Redis when
+# REDIS_URL is set, an in-process SimpleCache otherwise (single-worker dev).
+if os.environ.get('REDIS_URL'):
+    cache = Cache(app, config={
+        'CACHE_TYPE': 'RedisCache',
+        'CACHE_REDIS_URL': os.environ['REDIS_URL']
+    })
+else:
+    cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
+
+HISTORY_TIMEOUT = 3600  # Seconds a user's history survives without activity
+
+def get_emotion_history():
+    """Fetch the current user's emotion history from the server-side cache"""
+    return cache.get(f"hist:{session['username']}") or []
+
+def save_emotion_history(history):
+    """Persist the current user's emotion history to the server-side cache"""
+    cache.set(f"hist:{session['username']}", history, timeout=HISTORY_TIMEOUT)
+
+# Configuration
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+_DOT_EXTENSIONS = tuple('.' + ext for ext in ALLOWED_EXTENSIONS)
+MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50MB max file size
+MAX_IMAGE_PIXELS = 4096 * 4096  # Reject anything larger before decoding
+# Bytes sniffed for the dimension check. Camera JPEGs park a multi-KB EXIF
+# blob before the SOF marker, so the prefix has to be generous enough to
+# reach it - 64KB covers real-world EXIF (thumbnails included) while still
+# avoiding a full read of oversized uploads
+DIMENSION_SNIFF_BYTES = 64 * 1024
+JPEG_QUALITY = 85
+ANNOTATION_CONFIDENCE_THRESHOLD = 50.0  # Below this, skip drawing the box
+REDUCED_DECODE_BYTES = 2 * 1024 * 1024  # Above this, decode at 1/4 scale
+
+# Annotated result JPEGs live in the shared cache layer, keyed by
+# result_id and served raw from /api/result/<id>.jpg (skips the 33% base64
+# overhead). The follow-up GET usually lands on a different gunicorn
+# worker than the one that processed the image, so a process-local dict
+# would 404 most of the time - Redis makes the bytes visible to all
+# workers, and entries expire instead of being size-evicted.
+RESULT_TIMEOUT = 600  # Seconds a result image stays fetchable
+
+def encode_jpeg(img):
+    """Encode a BGR image to JPEG bytes, via libjpeg-turbo when available"""
+    if _turbo_jpeg is not None:
+        if isinstance(img, cv2.UMat):
+            img = img.get()  # TurboJPEG needs a host-side ndarray
+        return _turbo_jpeg.encode(img, quality=JPEG_QUALITY)
+    # cv2.imencode is UMat-aware, no download needed
+    _, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return buffer.tobytes()
+
+def cache_result(jpeg_bytes):
+    """Store result bytes in the shared cache under a fresh id"""
+    result_id = uuid.uuid4().hex
+    cache.set(f"result:{result_id}", jpeg_bytes, timeout=RESULT_TIMEOUT)
+    return result_id
+
+def allowed_file(filename):
+    """Check if uploaded file has an allowed extension"""
+    # Single C-level endswith against precomputed suffixes - no rsplit
+    # allocation per request on the hot endpoint
+    return filename.lower().endswith(_DOT_EXTENSIONS)
+
+@app.route('/')
+def home():
+    """Redirect to login if not authenticated, otherwise to main app"""
+    if 'username' in session:
+        return redirect(url_for('index'))
+    return redirect(url_for('login'))
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    """Handle user login with hardcoded credentials (user/54321)"""
+    if request.method == 'POST':
+        username = request.form.get('username', '')
+        password = request.form.get('password', '')
+        
+        # Validate credentials
+        if username == 'user' and password == '54321':
+            session['username'] = username
+            save_emotion_history([])  # Start this login with a fresh history
+            return redirect(url_for('index'))
+        else:
+            return render_template('login.html', error='Invalid username or password')
+    
+    return render_template('login.html')
+
+@app.route('/logout')
+def logout():
+    """Clear session and redirect to login"""
+    session.clear()
+    return redirect(url_for('login'))
+
+@app.route('/index')
+def index():
+    """Main app page - image upload and emotion detection"""
+    if 'username' not in session:
+        return redirect(url_for('login'))
+    return render_template('index.html')
+
+@app.route('/dashboards')
+def dashboards():
+    """Analytics dashboard with charts and history"""
+    if 'username' not in session:
+        return redirect(url_for('login'))
+    return render_template('dashboards.html')
+
+@app.route('/api/process-emotion', methods=['POST'])
+def process_emotion():
+    """
+    Main API endpoint for emotion detection
+    1. Receives uploaded image and decodes it in memory
+    2. Detects face and emotion using DeepFace
+    3. Draws bounding box on image and caches the annotated JPEG
+    4. Returns emotion data plus a URL for the result image
+    5. Stores result in server-side history
+    """
+    try:
+        if 'username' not in session:
+            return json_response({'message': 'Not authenticated'}, 401)
+
+        if 'image' not in request.files:
+            return json_response({'message': 'No image provided'}, 400)
+
+        file = request.files['image']
+        if file.filename == '' or not allowed_file(file.filename):
+            return json_response({'message': 'Invalid file'}, 400)
+
+        # Sniff dimensions from the header and reject huge images before
+        # paying for a full decode
+        header = file.stream.read(DIMENSION_SNIFF_BYTES)
+        file.stream.seek(0)
+        try:
+            width, height = imagesize.get(io.BytesIO(header))
+        except Exception:
+            width = height = -1  # Unknown format header - let the decoder decide
+        if width > 0 and height > 0 and width * height > MAX_IMAGE_PIXELS:
+            return json_response({'message': 'Image dimensions too large'}, 413)
+
+        # Decode the upload in memory - no temp file round-trip. A 50MB
+        # JPEG decodes to ~500MB of BGR, so large files decode at 1/4
+        # scale instead (libjpeg's DCT-domain scaling, essentially free),
+        # cutting peak memory 16x. Detection, drawing, and the returned
+        # image all work on the same downscaled frame, so no coordinate
+        # rescaling is needed.
+        data = file.read()
+        arr = np.frombuffer(data, np.uint8)
+        decode_flag = cv2.IMREAD_REDUCED_COLOR_4 if len(data) > REDUCED_DECODE_BYTES \
+            else cv2.IMREAD_COLOR
+        img = cv2.imdecode(arr, decode_flag)
+        if img is None:
+            return json_response({'message': 'Error reading image'}, 500)
+
+        # Recognize emotion on the already-decoded array
+        emotion_result = recognize_emotion(img)
+
+        if emotion_result is None:
+            return json_response({'message': 'No face detected in image'}, 400)
+
+        box = emotion_result['box']
+        x, y, w, h = box['x'], box['y'], box['w'], box['h']
+        frame_area = img.shape[0] * img.shape[1]
+
+        # A low-confidence result or a box spanning the whole frame (the
+        # detector's no-face fallback) isn't worth annotating - and for
+        # JPEG uploads the original bytes can be returned verbatim,
+        # skipping the re-encode entirely.
+        needs_annotation = (
+            emotion_result['confidence'] >= ANNOTATION_CONFIDENCE_THRESHOLD
+            and w * h < 0.95 * frame_area
+        )
+
+        if needs_annotation:
+            # Draw bounding box around detected face with emotion label.
+            # UMat dispatches the rasterization to OpenCL when OpenCV has a
+            # GPU device available; falls back to CPU transparently otherwise.
+            canvas = cv2.UMat(img)
+            label_text = f"{emotion_result['label']} ({emotion_result['confidence']:.1f}%)"
+            if w * h > 0.5 * frame_area:
+                # Selfie fast path: the face fills the frame, so the box adds
+                # nothing - just pin the label to the top-left corner
+                cv2.putText(canvas, label_text, (10, 30),
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
+            else:
+                cv2.rectangle(canvas, (x, y), (x + w, y + h), (0, 255, 0), 2)
+                cv2.putText(canvas, label_text, (x, y - 10),
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
+            jpeg_bytes = encode_jpeg(canvas)
+        elif file.filename.lower().endswith(('.jpg', '.jpeg')):
+            jpeg_bytes = data  # Already JPEG - no decode/draw/encode cycle
+        else:
+            jpeg_bytes = encode_jpeg(img)  # Transcode other formats, undrawn
+
+        # Park the result image for the result endpoint
+        result_id = cache_result(jpeg_bytes)
+
+        # Generate timestamp-based filename for history tracking
+        filename = f"{emotion_result['label']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        
+        # Convert confidence to regular float for JSON serialization
+        confidence = float(emotion_result['confidence'])
+        
+        # Store emotion data in server-side history for dashboard analytics
+        history = get_emotion_history()
+        history.append({
+            'emotion': emotion_result['label'],
+            'confidence': confidence,
+            'filename': filename
+        })
+        save_emotion_history(history)
+
+        # Return analysis data plus a URL for the annotated JPEG. Mood text
+        # streams separately via /api/mood-stream so the image isn't held
+        # back by LLM generation time.
+        return json_response({
+            'image_url': url_for('get_result_image', result_id=result_id),
+            'emotion': emotion_result['label'],
+            'confidence': confidence
+        })
+    except Exception as e:
+        return json_response({'message': f'Error: {str(e)}'}, 500)
+
+@app.route('/api/mood-stream')
+def mood_stream():
+    """Stream the AI-generated mood text as server-sent events"""
+    if 'username' not in session:
+        return json_response({'message': 'Not authenticated'}, 401)
+
+    # Only the detector's own labels are accepted - anything else would
+    # splice arbitrary user text into the LLM prompt and trigger a paid
+    # generation per unique string
+    emotion = request.args.get('emotion', '')
+    if emotion not in EMOTION_LABELS:
+        return json_response({'message': 'Unknown emotion'}, 400)
+    try:
+        confidence = float(request.args.get('confidence', 0))
+    except ValueError:
+        confidence = 0.0
+
+    def generate():
+        for chunk in stream_mood_content(emotion, confidence):
+            # JSON-encode each chunk so newlines survive the SSE framing
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "event: done\ndata: \"\"\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+@app.route('/api/result/<result_id>.jpg')
+def get_result_image(result_id):
+    """Serve an annotated result JPEG as raw bytes (no base64 round-trip)"""
+    if 'username' not in session:
+        return json_response({'message': 'Not authenticated'}, 401)
+
+    jpeg_bytes = cache.get(f"result:{result_id}")
+    if jpeg_bytes is None:
+        return json_response({'message': 'Result not found'}, 404)
+
+    return send_file(io.BytesIO(jpeg_bytes), mimetype='image/jpeg')
+
+@app.route('/api/get-history')
+def get_history():
+    """Retrieve emotion detection history for current session"""
+    if 'username' not in session:
+        return json_response({'message': 'Not authenticated'}, 401)
+    
+    return json_response({'history': get_emotion_history()})
+
+@app.route('/api/clear-history', methods=['POST'])
+def clear_history():
+    """Clear all emotion history for current session"""
+    if 'username' not in session:
+        return json_response({'message': 'Not authenticated'}, 401)
+    
+    save_emotion_history([])
+    return json_response({'message': 'History cleared'})
+
+if __name__ == '__main__':
+    # Development only - single-threaded and reloads on file changes.
+    # In production run under gunicorn; each worker warms its models
+    # during boot, before accepting traffic (see gunicorn.conf.py):
+    #   gunicorn --config gunicorn.conf.py app:app
+    app.run(debug=True)
@@ -0,0 +1,45 @@
+"""
+Export DeepFace's emotion CNN to ONNX for fast inference
+Run once on the deployment box, then helpers.py picks up emotion.onnx
+(or the INT8-quantized emotion.int8.onnx, preferred) automatically and
+serves the emotion head through ONNX Runtime.
+
+For NVIDIA hardware, build a TensorRT engine from the exported model:
+    trtexec --onnx=emotion.onnx --fp16 --saveEngine=emotion.plan
+or, with an INT8 calibration cache built from ~200 held-out FER images:
+    trtexec --onnx=emotion.onnx --int8 --calib=calib.cache --saveEngine=emotion.plan
+"""
+from deepface import DeepFace
+import tf2onnx
+
+OUTPUT_PATH = "emotion.onnx"
+INT8_OUTPUT_PATH = "emotion.int8.onnx"
+
+
+def export():
+    """Build the Keras emotion model and convert it to ONNX opset 13"""
+    model = DeepFace.build_model("Emotion")
+    # Newer DeepFace versions wrap the Keras model in a client object
+    keras_model = getattr(model, "model", model)
+
+    tf2onnx.convert.from_keras(keras_model, opset=13, output_path=OUTPUT_PATH)
+    print(f"Exported emotion model to {OUTPUT_PATH}")
+
+
+def quantize():
+    """
+    Dynamically quantize the exported model's weights to INT8
+
+    A 7-class softmax over a 48x48 gray crop tolerates INT8 with
+    negligible accuracy loss; weight memory halves and CPUs with VNNI
+    get roughly 2x throughput from INT8 dot products.
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(OUTPUT_PATH, INT8_OUTPUT_PATH, weight_type=QuantType.QInt8)
+    print(f"Quantized model written to {INT8_OUTPUT_PATH}")
+
+
+if __name__ == '__main__':
+    export()
+    quantize()
@@ -0,0 +1,20 @@
+"""
+Gunicorn configuration for the emotion detector
+Run the production server with:
+    gunicorn --config gunicorn.conf.py app:app
+"""
+bind = "0.0.0.0:8000"
+workers = 4
+worker_class = "gevent"
+worker_connections = 100
+timeout = 60
+
+# Preloading is deliberately off. Importing the app in the master would run
+# the DeepFace warm-up there, and a CUDA context initialized before fork()
+# cannot be used in the forked children - on GPU boxes the workers fail or
+# hang at first inference. gevent's monkey-patching after the app is
+# imported in the master is likewise unsupported. Each worker therefore
+# imports the app after fork and warms its own models during boot.
+# CPU-only deployments may set this to True to share the ~500MB of model
+# weights across workers via copy-on-write.
+preload_app = False
@@ -1,67 +1,375 @@
-"""
-Emotion Detection Helpers
-Contains core functions for emotion recognition and mood content generation
-"""
-from deepface import DeepFace 
-import ollama
-
-def recognize_emotion(img_path):
-    """
-    Detect face and emotion in an image using DeepFace
-    
-    Args:
-        img_path (str): Path to the image file
-        
-    Returns:
-        dict: Contains bounding box, emotion label, and confidence score
-        Returns None if no face detected
-    """
-    if img_path is None:
-        return None
-
-    # Analyze image using DeepFace with emotion detection
-    results = DeepFace.analyze(
-        img_path = img_path, 
-        actions = ['emotion'], 
-        detector_backend = 'retinaface', # Recommended for stable bounding boxes 
-        enforce_detection = False
-    )
-    
-    # Extract first detected face data
-    face_data = results[0]
-    
-    return {
-        "box": face_data['region'], # Bounding box coordinates (x, y, w, h)
-        "label": face_data['dominant_emotion'], # Detected emotion
-        "confidence": face_data['emotion'][face_data['dominant_emotion']]# Confidence score
-    }
-
-def generate_mood_content(emotion_label, confidence):
-    """
-    Generate AI-based mood insights and playlist recommendation
-    Uses Ollama with Gemma model for fast, lightweight text generation
-    
-    Args:
-        emotion_label (str): The detected emotion
-        confidence (float): Confidence score (0-100)
-        
-    Returns:
-        str: AI-generated mood description with music playlist suggestion
-    """
-    # Create prompt for AI to generate contextual mood content
-    prompt = f"The detected emotion is {emotion_label}. Suggest a 3-song playlist that matches it. Start by saying: 'Tonight's vibe is {emotion_label}. I'm {confidence:.1f}% sure about it... (here give a short description of the mood)... For that reason, here are some songs to match the mood.' and then give the playlist you suggest. No final questions or suggestions."
-    
-    # Call Ollama with Gemma model for music curation
-    response = ollama.chat(
-        model="gemma3:1b", # Lightweight model for real-time applications
-        messages=[
-            {"role": "system", "content": "You are a professional music curator and psychologist."},
-            {"role": "user", "content": prompt}
-        ],
-        options={
-            "temperature": 0.7  # High temperature for creativity in music suggestions
-        }
-    )
-    
-    return response['message']['content']
-    
+"""
+Emotion Detection Helpers
+Contains core functions for emotion recognition and mood content generation
+"""
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+# Pin the GPU before TensorFlow is imported (DeepFace imports it)
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "0")
+
+from deepface import DeepFace
+import cv2
+import numpy as np
+import ollama
+import tensorflow as tf
+
+# Grow GPU memory on demand instead of grabbing it all up front (avoids OOM
+# when the detector and emotion model share the device)
+_gpus = tf.config.list_physical_devices('GPU')
+for _gpu in _gpus:
+    tf.config.experimental.set_memory_growth(_gpu, True)
+
+# Run inference on the GPU when one is visible, otherwise fall back to CPU
+_TF_DEVICE = '/GPU:0' if _gpus else '/CPU:0'
+
+# Emotion classes in the output order of DeepFace's emotion CNN
+EMOTION_LABELS = ('angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral')
+
+# Face detector backend. YuNet is OpenCV's 340KB detection CNN - several
+# times faster than RetinaFace's ResNet-50 backbone with acceptable
+# accuracy for downstream emotion classification. Set back to 'retinaface'
+# if detection quality ever becomes the bottleneck.
+DETECTOR_BACKEND = os.environ.get("DETECTOR_BACKEND", "yunet")
+
+# Optional ONNX/TensorRT fast path for the emotion classifier. Export the
+# Keras model with export_emotion_onnx.py; when the exported model and
+# onnxruntime are both present, the 7-class head runs through ONNX Runtime
+# (TensorRT/CUDA when available) and DeepFace only does face detection.
+EMOTION_ONNX_PATH = os.environ.get(
+    "EMOTION_ONNX_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "emotion.onnx")
+)
+
+# The INT8-quantized export (emotion.int8.onnx) is preferred when present:
+# half the weight memory and ~2x throughput on VNNI CPUs for negligible
+# accuracy loss on a 7-class head
+EMOTION_ONNX_INT8_PATH = os.environ.get(
+    "EMOTION_ONNX_INT8_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "emotion.int8.onnx")
+)
+
+_onnx_session = None
+_onnx_input_name = None
+try:
+    import onnxruntime
+    _onnx_model_path = next(
+        (p for p in (EMOTION_ONNX_INT8_PATH, EMOTION_ONNX_PATH) if os.path.exists(p)),
+        None
+    )
+    if _onnx_model_path is not None:
+        _onnx_session = onnxruntime.InferenceSession(
+            _onnx_model_path,
+            providers=["TensorrtExecutionProvider", "CUDAExecutionProvider", "CPUExecutionProvider"]
+        )
+        _onnx_input_name = _onnx_session.get_inputs()[0].name
+except ImportError:
+    # onnxruntime not installed - stay on the Keras path
+    pass
+
+
+def _preprocess_face(img, region):
+    """
+    Crop the detected face and shape it for the emotion CNN
+
+    Args:
+        img (np.ndarray): Full BGR image
+        region (dict): Bounding box with x, y, w, h keys
+
+    Returns:
+        np.ndarray: Float32 tensor of shape (1, 48, 48, 1) scaled to [0, 1]
+    """
+    x, y, w, h = region['x'], region['y'], region['w'], region['h']
+    # Clamp to the frame - some detectors report boxes that spill over edges
+    x, y = max(x, 0), max(y, 0)
+    crop = img[y:y + h, x:x + w]
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    gray = cv2.resize(gray, (48, 48), interpolation=cv2.INTER_AREA)
+    # Single float conversion; copy=False avoids an extra buffer when the
+    # resize output is already float-compatible
+    face = gray.astype(np.float32, copy=False) * (1.0 / 255.0)
+    return face.reshape(1, 48, 48, 1)
+
+
+# Micro-batching for the emotion classifier. Flask handles each request on
+# its own thread, so independent users' crops used to serialize through the
+# model one at a time. Requests now enqueue their preprocessed crop and a
+# background worker runs a single predict on up to _BATCH_MAX stacked
+# tensors, fanning results back out through per-request events.
+_BATCH_MAX = 32           # Max crops per predict call
+_BATCH_WINDOW = 0.008     # Seconds to wait for more work before flushing
+_CLASSIFY_TIMEOUT = 30    # Seconds a request waits on its batch before erroring
+
+_batch_queue = queue.Queue()
+
+
+def _classify_batch(faces):
+    """Run one forward pass over a list of (1, 48, 48, 1) face tensors"""
+    batch = np.concatenate(faces, axis=0)
+    if _onnx_session is not None:
+        return _onnx_session.run(None, {_onnx_input_name: batch})[0]
+    model = DeepFace.build_model("Emotion")  # Singleton-cached by DeepFace
+    with tf.device(_TF_DEVICE):
+        return model.model.predict(batch, verbose=0) if hasattr(model, 'model') \
+            else model.predict(batch, verbose=0)
+
+
+def _batch_worker():
+    """Drain the queue in small batches and fan results back to requests"""
+    while True:
+        items = [_batch_queue.get()]
+        deadline = time.monotonic() + _BATCH_WINDOW
+        while len(items) < _BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(_batch_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # A failed forward pass must not kill the worker thread - deliver
+        # the exception to the waiting requests (surfaced as per-request
+        # 500s, like any other handler error) and keep draining
+        try:
+            probs = _classify_batch([face for face, _, _ in items])
+        except Exception as e:
+            for _, done, result in items:
+                result.append(e)
+                done.set()
+            continue
+        for (_, done, result), p in zip(items, probs):
+            result.append(p)
+            done.set()
+
+
+# The worker thread must be started lazily in the serving process rather
+# than at import: under gunicorn --preload this module is imported once in
+# the master and threads don't survive fork(), which would leave every
+# forked worker enqueueing crops with nothing alive to drain the queue.
+# Tracking the PID restarts the thread in each process after a fork.
+_batch_worker_lock = threading.Lock()
+_batch_worker_pid = None
+
+
+def _ensure_batch_worker():
+    """Start the batch worker thread in the current process if needed"""
+    global _batch_worker_pid
+    if _batch_worker_pid == os.getpid():
+        return
+    with _batch_worker_lock:
+        if _batch_worker_pid != os.getpid():
+            threading.Thread(target=_batch_worker, daemon=True).start()
+            _batch_worker_pid = os.getpid()
+
+
+def _classify_emotion(face):
+    """Enqueue a preprocessed crop and block until its batch is scored"""
+    _ensure_batch_worker()
+    done = threading.Event()
+    result = []
+    _batch_queue.put((face, done, result))
+    if not done.wait(timeout=_CLASSIFY_TIMEOUT):
+        raise RuntimeError("Emotion classification timed out")
+    if isinstance(result[0], Exception):
+        raise result[0]
+    return result[0]
+
+
+def recognize_emotion(img):
+    """
+    Detect face and emotion in an image using DeepFace
+
+    Args:
+        img (np.ndarray): Decoded BGR image array
+
+    Returns:
+        dict: Contains bounding box, emotion label, and confidence score
+        Returns None if no face detected
+    """
+    if img is None:
+        return None
+
+    # Detect the face, then classify the crop through the shared batcher
+    faces = DeepFace.extract_faces(
+        img_path = img,
+        detector_backend = DETECTOR_BACKEND,
+        enforce_detection = False,
+        align = False
+    )
+    region = faces[0]['facial_area']
+    box = {k: region[k] for k in ('x', 'y', 'w', 'h')}
+
+    face = _preprocess_face(img, box)
+    probs = _classify_emotion(face)
+    idx = int(np.argmax(probs))
+
+    return {
+        "box": box, # Bounding box coordinates (x, y, w, h)
+        "label": EMOTION_LABELS[idx], # Detected emotion
+        "confidence": float(probs[idx]) * 100 # Confidence score
+    }
+
+# Generated mood text cached by (emotion, confidence decile) - users can't
+# tell a 82.3% from an 87.1% playlist apart, so repeat buckets become a
+# dict lookup instead of a multi-second LLM call. Only labels outside the
+# curated playlist set reach the LLM at all, so the cache is explicitly
+# capped with FIFO eviction rather than trusting the key space to stay
+# small.
+_MOOD_CACHE_MAX = 256
+_mood_cache = {}
+
+# Pre-curated playlists keyed by emotion. The mood text has a fixed format,
+# which makes it a templating job rather than a runtime LLM job: sample a
+# curated playlist, fill in the template, done - microseconds instead of a
+# multi-second Ollama generation. Ollama remains the fallback for emotion
+# labels not covered by the curated set.
+_PLAYLISTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "playlists.json")
+try:
+    with open(_PLAYLISTS_PATH) as _f:
+        _PLAYLISTS = json.load(_f)
+except (OSError, ValueError):
+    _PLAYLISTS = {}
+
+# Short mood blurbs for the template, one per FER emotion
+_MOOD_DESCRIPTIONS = {
+    "angry": "There's fire in the air - sharp edges, clenched energy that needs somewhere loud to go",
+    "disgust": "Something's left a bad taste - a wry, eye-rolling mood that wants attitude in the speakers",
+    "fear": "Things feel tense and uncertain - a wary mood that calls for something atmospheric to sit with",
+    "happy": "Everything's clicking - bright, buoyant energy that deserves a soundtrack to match",
+    "sad": "It's a heavy-hearted evening - soft around the edges, the kind that wants company more than cheering up",
+    "surprise": "Something unexpected just landed - wide-eyed energy looking for twists and big moments",
+    "neutral": "A calm, even-keeled mood - nothing to fix, just space for something easy in the background"
+}
+
+_MOOD_TEMPLATE = (
+    "Tonight's vibe is {emotion}. I'm {confidence:.1f}% sure about it... "
+    "{description}... For that reason, here are some songs to match the mood.\n\n"
+    "{songs}"
+)
+
+def _templated_mood_content(emotion_label, confidence):
+    """Fill the mood template from a sampled curated playlist"""
+    songs = random.choice(_PLAYLISTS[emotion_label])
+    return _MOOD_TEMPLATE.format(
+        emotion = emotion_label,
+        confidence = confidence,
+        description = _MOOD_DESCRIPTIONS.get(emotion_label, "The mood is unmistakable"),
+        songs = '\n'.join(f"{i}. {song}" for i, song in enumerate(songs, 1))
+    )
+
+# Constant system prompt - identical token prefix on every call so Ollama
+# can reuse its prefill KV cache instead of re-encoding the instructions
+_MOOD_SYSTEM_PROMPT = (
+    "You are a professional music curator and psychologist. You will be given a "
+    "detected emotion and a confidence score. Suggest a 3-song playlist that "
+    "matches the emotion. Start by saying: 'Tonight's vibe is <emotion>. I'm "
+    "<confidence>% sure about it... (here give a short description of the "
+    "mood)... For that reason, here are some songs to match the mood.' and then "
+    "give the playlist you suggest. No final questions or suggestions."
+)
+
+def _mood_cache_key(emotion_label, confidence):
+    """Bucket confidence into deciles so near-identical prompts share text"""
+    return (emotion_label, round(confidence / 10))
+
+def stream_mood_content(emotion_label, confidence):
+    """
+    Stream AI-based mood insights and playlist recommendation
+    Uses Ollama with Gemma model for fast, lightweight text generation
+
+    Args:
+        emotion_label (str): The detected emotion
+        confidence (float): Confidence score (0-100)
+
+    Yields:
+        str: Text chunks as the model produces them
+    """
+    # Known emotions are a template fill over the curated playlists - no
+    # LLM round-trip at all
+    if emotion_label in _PLAYLISTS:
+        yield _templated_mood_content(emotion_label, confidence)
+        return
+
+    # Serve from cache when this emotion/confidence bucket was seen before
+    cache_key = _mood_cache_key(emotion_label, confidence)
+    cached = _mood_cache.get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    # Call Ollama with Gemma model for music curation, streaming tokens as
+    # they are generated instead of blocking on the full response. All the
+    # formatting instructions live in the constant system prompt so its
+    # prefill KV cache is reused across calls (Ollama matches on prefix
+    # tokens); only the short emotion/confidence user turn varies.
+    # keep_alive pins the model in memory between requests - set
+    # OLLAMA_KEEP_ALIVE on the server to match.
+    stream = ollama.chat(
+        model="gemma3:1b", # Lightweight model for real-time applications
+        messages=[
+            {"role": "system", "content": _MOOD_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Detected emotion: {emotion_label}. Confidence: {confidence:.1f}%."}
+        ],
+        options={
+            "temperature": 0.7  # High temperature for creativity in music suggestions
+        },
+        keep_alive="24h",
+        stream=True
+    )
+
+    parts = []
+    for part in stream:
+        chunk = part['message']['content']
+        if chunk:
+            parts.append(chunk)
+            yield chunk
+
+    # Store the full text for every later request in this bucket, evicting
+    # the oldest entry once the cap is reached (dicts iterate in insertion
+    # order)
+    if len(_mood_cache) >= _MOOD_CACHE_MAX:
+        _mood_cache.pop(next(iter(_mood_cache)))
+    _mood_cache[cache_key] = ''.join(parts)
+
+def generate_mood_content(emotion_label, confidence):
+    """
+    Generate the full mood text in one blocking call
+
+    Args:
+        emotion_label (str): The detected emotion
+        confidence (float): Confidence score (0-100)
+
+    Returns:
+        str: AI-generated mood description with music playlist suggestion
+    """
+    return ''.join(stream_mood_content(emotion_label, confidence))
+
+
+def _warm_up_models():
+    """
+    Pre-build the emotion CNN and face detector at import time
+
+    DeepFace lazy-loads its models on the first analyze() call, which adds
+    10-20s of cold-start latency to the first request of every worker.
+    Building the model and running a dummy inference here fills DeepFace's
+    internal singleton cache during boot instead. Each gunicorn worker
+    imports this module after fork, so warm-up runs once per worker before
+    it accepts traffic (CUDA contexts can't be shared across fork, so the
+    warm-up must not run in the master on GPU deployments).
+    """
+    # The Keras emotion model is only needed when the ONNX fast path isn't
+    # loaded - building it anyway would cost every worker the multi-second
+    # load and resident memory of a model _classify_batch never calls
+    if _onnx_session is None:
+        DeepFace.build_model("Emotion")
+    # Dummy inference warms the face detector and the batch worker (and the
+    # ONNX session, when active)
+    recognize_emotion(np.zeros((224, 224, 3), dtype=np.uint8))
+
+# Warm up once at import so requests only pay pure inference time
+_warm_up_models()
+